@@ -7,30 +7,57 @@ Description:
     has grown so that a user only ever really has to specify what directory to backup, and
     if there is any pre/post actions they need doing first/last, eg, dump a database first.
 
-    Each item specified in the config.json file is parsed and is queued to run in its own thread
-    in the order pre-action->tar->post-action.
+    Each item specified in the config.json file is parsed and its jobs are run as child processes
+    in the order pre-action->tar->post-action, with up to max_parallel_jobs items running
+    alongside each other and the cpus split between their compressors.
     Ensure all mandatory keys are specified, or program will exit.
     If an item is not enabled, it will be skipped.
 """
 
-import argparse
-import collections
-import datetime as t
+import copy
+import glob
 import json
 import logging as log
 import os
 import os.path as p
+import shlex
+import shutil
+import sqlite3
+import struct
 import subprocess
-import sys
-import textwrap
-import time
-from subprocess import PIPE, Popen
-import threading
+from dataclasses import dataclass, fields
 from timeit import default_timer as timer
-from typing import NamedTuple
+from typing import List, NamedTuple, Optional, Union
 
 LOCK_FILE_NAME = "backup.lock"
 CONFIG_FILE_NAME = "config.json"
+# Per item cache of the source tree's file metadata as of the last successful tar
+META_CACHE_NAME = ".meta.sqlite"
+# inode, mtime_ns, size and ctime_ns of each path in the cache, packed into 32 bytes
+STAT_RECORD = struct.Struct("<Qqqq")
+# Compressors tar can hand its output to, name -> (compress program, archive extension).
+# A program of None means tar's own built in gzip, and {threads} is filled in with the
+# number of threads each compressor gets.
+COMPRESSORS = {
+    "zstd": ("zstd -T{threads} -3 --long=27 --adapt", "tar.zst"),
+    "qzip": ("qzip", "tar.gz"),
+    "pigz": ("pigz -p {threads}", "tar.gz"),
+    "gzip": (None, "tar.gz"),
+}
+DEFAULT_COMPRESSOR = "zstd"
+# Device node of the Intel QuickAssist (QAT) driver, which lets qzip (QATzip) do gzip's
+# DEFLATE in hardware. Without it qzip falls back to software, so pigz is the better pick.
+QAT_DEVICE = "/dev/qat_adf_ctl"
+# Characters that mean an action needs a shell to run (pipes, redirects, variables, globs,
+# subshells, comments, multi-line scripts...)
+SHELL_METACHARS = frozenset("|&;<>$`*?~()[]{}!#\n")
+# Preallocated archive size, as a fraction of the changed source data (a rough guess at
+# compression), capped at this fraction of the destination's free space so several items
+# preallocating at once can't run each other out of room
+PREALLOCATE_RATIO = 0.5
+PREALLOCATE_MAX_FREE = 0.25
+# Number of statx calls submitted to io_uring at once by scan_tree_iouring
+IOURING_DEPTH = 256
 
 
 class ScriptAction(NamedTuple):
@@ -38,121 +65,505 @@ class ScriptAction(NamedTuple):
     Named tuple class for storing specific script actions.
     These can then be accessed as eg object_name.preaction
     """
-    preaction: str
-    postaction: str
+    preaction: Union[str, List[str]]
+    postaction: Union[str, List[str]]
     showtime: bool
     log_file: str
+    max_parallel_jobs: int
+
+
+@dataclass(slots=True)
+class ConfigItem:
+    """
+    Dataclass for a single item of the config.json backup_list, see the
+    README for what each option does
+    """
+    name: str
+    enabled: bool
+    src_path: Optional[str] = None
+    dest_path: Optional[str] = None
+    pre_action: Optional[str] = None
+    post_action: Optional[str] = None
+    tar_opts: Optional[str] = None
+    show_time_taken: Optional[bool] = None
+    bundle: Optional[str] = None
+    preallocate: Optional[bool] = None
+    compressor: str = DEFAULT_COMPRESSOR
+    skip_unchanged: Optional[bool] = None
+
+
+CONFIG_ITEM_KEYS = frozenset(f.name for f in fields(ConfigItem))
 
 
 def is_valid(_item):
-    """ Checks a passed in item has the required fields """
+    """ Checks a passed in (json dict) item has the required fields """
     # A list of required keys for the config.json file
     reqd_keys = [
         "name",
         "enabled",
     ]
 
-    for prop in reqd_keys:
-        try:
-            getattr(_item, prop)
-        except AttributeError:
-            log.error("Missing json key: {}".format(prop))
-            return False
+    missing = [key for key in reqd_keys if key not in _item]
+    if missing:
+        log.error("Missing json keys: %s", ", ".join(missing))
+        return False
     return True
 
 
+def split_action(action):
+    """
+    Splits a pre/post action into an argv list so it can be run without a shell, unless
+    it uses shell syntax, in which case the string is returned to be run through one
+    """
+    if not action or any(c in SHELL_METACHARS for c in action):
+        return action
+    try:
+        argv = shlex.split(action)
+    except ValueError:
+        # eg an unbalanced quote, let the shell deal with (and report) it
+        return action
+    # Anything that isn't a program on the PATH (a builtin such as cd or :, a keyword, a
+    # leading VAR=value assignment...) needs the shell as well
+    if not argv or shutil.which(argv[0]) is None:
+        return action
+    return argv
+
+
+def format_time(seconds):
+    """ Formats a duration as eg "02 mins 05 seconds", with hours only if it took over an hour """
+    mins, secs = divmod(int(seconds), 60)
+    hours, mins = divmod(mins, 60)
+    if hours:
+        return f"{hours:02d} hrs {mins:02d} mins {secs:02d} seconds"
+    return f"{mins:02d} mins {secs:02d} seconds"
+
+
+def find_compressor(name, threads=1):
+    """
+    Returns the (compress program, archive extension) to use for the named compressor,
+    running with up to threads threads.
+    Falls back to gzip if the name is unknown or its program isn't installed, and gzip
+    itself is done in hardware by qzip when there's a QAT accelerator, otherwise by
+    pigz when that is installed.
+    """
+    if name not in COMPRESSORS:
+        log.warning("Unknown compressor %s, using gzip", name)
+        name = "gzip"
+    program, _ = COMPRESSORS[name]
+    if program and not shutil.which(program.split()[0]):
+        log.warning("%s is not installed, using gzip", name)
+        name = "gzip"
+    if name == "gzip":
+        if shutil.which("qzip") and p.exists(QAT_DEVICE):
+            name = "qzip"
+        elif shutil.which("pigz"):
+            name = "pigz"
+    program, extension = COMPRESSORS[name]
+    if program:
+        program = program.format(threads=threads)
+    return program, extension
+
+
+def scan_tree(root):
+    """
+    Walks root, returning a dict of path -> packed STAT_RECORD for every file and
+    directory under it, root included
+    """
+    def scan_error(err):
+        log.warning("Could not scan %s: %s", err.filename, err.strerror)
+
+    st = os.stat(root, follow_symlinks=False)
+    snapshot = {root: STAT_RECORD.pack(st.st_ino, st.st_mtime_ns, st.st_size, st.st_ctime_ns)}
+    # Every entry, directories included, is stat'ed here even though fwalk has already
+    # stat'ed the directories internally, as it doesn't hand those results back.
+    # Tracking which directories it walked to fstat their fds instead measured no faster.
+    for dirpath, dirnames, filenames, dirfd in os.fwalk(root, onerror=scan_error):
+        for name in dirnames + filenames:
+            try:
+                st = os.stat(name, dir_fd=dirfd, follow_symlinks=False)
+            except OSError:
+                continue
+            snapshot[p.join(dirpath, name)] = STAT_RECORD.pack(st.st_ino, st.st_mtime_ns,
+                                                               st.st_size, st.st_ctime_ns)
+    return snapshot
+
+
+def iouring_available():
+    """ Checks liburing is installed and the kernel is new enough for IORING_OP_STATX (5.6) """
+    # Optional, and a compiled extension, so only loaded when --use-iouring asks for it
+    try:
+        import liburing
+    except ImportError:
+        log.warning("liburing is not installed, scanning without io_uring")
+        return False
+    release = tuple(int(n) for n in os.uname().release.split(".")[:2] if n.isdigit())
+    if release < (5, 6):
+        log.warning("Kernel %s is too old for io_uring statx, scanning without io_uring",
+                    os.uname().release)
+        return False
+    # io_uring can also be switched off (kernel.io_uring_disabled) or blocked by seccomp
+    ring = liburing.Ring()
+    try:
+        liburing.io_uring_queue_init(1, ring)
+    except OSError as err:
+        log.warning("Could not set up io_uring (%s), scanning without it", err.strerror)
+        return False
+    liburing.io_uring_queue_exit(ring)
+    return True
+
+
+def scan_tree_iouring(root):
+    """
+    Same as scan_tree, but the stat calls are batched up and submitted to an io_uring
+    IOURING_DEPTH at a time, rather than made one syscall each. Directories are still
+    listed with os.scandir, as io_uring has no getdents. Only used once
+    iouring_available() has checked liburing can be imported.
+    """
+    import liburing
+
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(IOURING_DEPTH, ring)
+    snapshot = {}
+
+    def stat_batch(paths):
+        stats = []
+        for i, path in enumerate(paths):
+            sqe = liburing.io_uring_get_sqe(ring)
+            stats.append(liburing.Statx())
+            liburing.io_uring_prep_statx(sqe, stats[i], path, liburing.AT_SYMLINK_NOFOLLOW)
+            sqe.user_data = i
+        liburing.io_uring_submit_and_wait(ring, len(paths))
+        for _ in paths:
+            liburing.io_uring_wait_cqe(ring, cqe)
+            entry = cqe[0]
+            i = entry.user_data
+            try:
+                entry.res  # raises if the statx failed, eg the file has since gone
+            except OSError as err:
+                # Like scan_tree, not being able to stat root itself is an error
+                if paths[i] == root:
+                    raise OSError(err.errno, os.strerror(err.errno), root) from err
+                continue
+            finally:
+                liburing.io_uring_cqe_seen(ring, entry)
+            # liburing only hands back float times, so these nanoseconds are off by
+            # up to ~100ns from scan_tree's. Switching between the two costs one extra tar.
+            st = stats[i]
+            snapshot[paths[i]] = STAT_RECORD.pack(st.ino, round(st.mtime * 1e9), st.size,
+                                                  round(st.ctime * 1e9))
+
+    try:
+        batch = [root]
+        dirs = [root]
+        while dirs:
+            path = dirs.pop()
+            try:
+                entries = os.scandir(path)
+            except OSError as err:
+                # As with os.stat in scan_tree, a root that can't be listed is raised,
+                # unless it is just a file
+                if path == root:
+                    if isinstance(err, NotADirectoryError):
+                        continue
+                    raise
+                log.warning("Could not scan %s: %s", err.filename, err.strerror)
+                continue
+            with entries:
+                for entry in entries:
+                    batch.append(entry.path)
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    if len(batch) == IOURING_DEPTH:
+                        stat_batch(batch)
+                        batch = []
+        if batch:
+            stat_batch(batch)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+    return snapshot
+
+
+def load_snapshot(cache_file):
+    """ Returns the snapshot stored in cache_file, or an empty dict if there isn't one """
+    if not p.exists(cache_file):
+        return {}
+    try:
+        with sqlite3.connect(cache_file) as conn:
+            return dict(conn.execute("SELECT path, stat FROM files"))
+    except sqlite3.Error as err:
+        log.warning("Could not read metadata cache %s: %s", cache_file, err)
+        return {}
+
+
+def save_snapshot(cache_file, snapshot, previous):
+    """ Updates the snapshot stored in cache_file, writing only what differs from previous """
+    try:
+        with sqlite3.connect(cache_file) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, stat BLOB)")
+            conn.executemany("DELETE FROM files WHERE path = ?",
+                             ((path,) for path in previous.keys() - snapshot.keys()))
+            conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                             ((path, stat) for path, stat in snapshot.items()
+                              if previous.get(path) != stat))
+    except sqlite3.Error as err:
+        log.warning("Could not write metadata cache %s: %s", cache_file, err)
+
+
 class BackupItem:
     """
     Backup item class holds all data about the commands to be run.
-    Each command is queued in a thread by calling *.queue_items, then when
-    *.start() is called, the job queue is processed.
+    Each command is queued by calling *.queue_items, then each call to *.start()
+    launches the next job in the queue, and *.finish() is called once it has exited.
     """
     def __init__(self, opt):
         self.job_queue = []
-        # These are all mandatory parameters and should never be empty at this point
+        self.current_job = None
+        self.start_time = None
+        self.tar_cmd = None
+        self.full_backup = False
+        self.meta_cache = None
+        self.snapshot = None
+        self.previous = None
+        self.tar_output = None
+        self.tar_output_fd = None
+        self.changed_size = 0
         self.name = opt.name
         self.enabled = opt.enabled
-        # optional parameters
-        self.src_path = getattr(opt, "src_path", None)
-        self.dest_path = getattr(opt, "dest_path", None)
-        self.pre_action = getattr(opt, "pre_action", None)
-        self.post_action = getattr(opt, "post_action", None)
-        self.tar_opts = getattr(opt, "tar_opts", None)
-        self.show_time = getattr(opt, "show_time_taken", None)
-
-    def is_enabled(self):
-        """ returns enabled state """
-        return self.enabled
-
-    def queue_items(self, full_backup=False):
+        # src_paths and pre/post actions are lists, as a bundle holds those of every item in it
+        self.src_paths = [opt.src_path] if opt.src_path else []
+        self.dest_path = opt.dest_path
+        # pre/post actions are split into argv lists once, here, rather than re-parsed
+        # by a shell every time they run (unless they need one)
+        self.pre_actions = [split_action(opt.pre_action)] if opt.pre_action else []
+        self.post_actions = [split_action(opt.post_action)] if opt.post_action else []
+        self.tar_opts = opt.tar_opts
+        self.show_time = opt.show_time_taken
+        self.bundle = opt.bundle
+        self.preallocate = opt.preallocate
+        self.compressor = opt.compressor
+        self.skip_unchanged = opt.skip_unchanged
+
+    def queue_items(self, full_backup=False, threads=1):
         """ Enqueues items into the job queue to process """
-        if self.pre_action:
-            self.job_queue.append(self.pre_action)
+        self.job_queue.extend(self.pre_actions)
 
-        if self.src_path and self.dest_path:
+        if self.src_paths and self.dest_path:
             # Now build our tar up to queue
-            full_destination_path = "{}/{}".format(self.dest_path, self.name)
+            full_destination_path = p.join(self.dest_path, self.name)
             if not p.exists(full_destination_path):
                 os.makedirs(full_destination_path)
 
+            if not full_backup:
+                # snar files are named after the date of the full backup, so the last
+                # one sorted is from the most recent full backup
+                snar_files = sorted(glob.glob(p.join(glob.escape(full_destination_path), '*snar')))
+                if snar_files:
+                    snar_file = snar_files[-1]
+                else:
+                    log.warning("No snar file found for %s, doing a full backup instead",
+                                self.name)
+                    full_backup = True
+
+            compress_program, extension = find_compressor(self.compressor, threads)
             if full_backup:
-                file_name = "full-{}-{}.tar.gz".format(self.name, date)
-                snar_file = "{}/{}-{}.snar".format(full_destination_path, self.name, date)
+                file_name = f"full-{self.name}-{date}.{extension}"
+                snar_file = p.join(full_destination_path, f"{self.name}-{date}.snar")
             else:
-                file_name = "i.{}-{}.tar.gz".format(self.name, date)
-                cmd = ['find', full_destination_path, '-name', '*snar']
-                output = Popen(cmd, stdout=PIPE).communicate()[0]
-                output = output.decode()
-                snar_file = output.split('\n')[0]
+                file_name = f"i.{self.name}-{date}.{extension}"
 
-            dest_path_and_file = "{}/{}".format(full_destination_path, file_name)
+            dest_path_and_file = p.join(full_destination_path, file_name)
 
-            tar_opts = 'zcPf'
+            compress_opts = []
+            if compress_program:
+                tar_opts = 'cPf'
+                compress_opts.append(f"--use-compress-program={compress_program}")
+            else:
+                tar_opts = 'zcPf'
             if self.tar_opts:
                 tar_opts += self.tar_opts
 
-            _built_cmd = ''
+            src_list = ", ".join(self.src_paths)
             if full_backup:
-                _built_cmd = "{0} {1}{2} {3}".format(dest_path_and_file, '--listed-incremental=',
-                                                      snar_file, self.src_path)
-                log.debug("Creating full backup file {0} from {1}".format(dest_path_and_file,
-                                                                        self.src_path))
+                log.debug("Creating full backup file %s from %s", dest_path_and_file, src_list)
             else:
-                tar_opts += 'g'
-                _built_cmd = "{0} {1} {2}".format(snar_file, dest_path_and_file, self.src_path)
-                log.debug("Creating incremental backup file {} from {}".format(dest_path_and_file,
-                                                                               self.src_path))
-
-            cmd = "tar {0} {1}".format(tar_opts, _built_cmd)
+                log.debug("Creating incremental backup file %s from %s", dest_path_and_file,
+                          src_list)
+
+            # To preallocate the archive, tar writes to stdout and start() hands it a
+            # preallocated file, as tar would truncate any preallocation itself
+            if self.preallocate:
+                self.tar_output = dest_path_and_file
+                dest_path_and_file = "-"
+
+            cmd = ["tar", tar_opts, dest_path_and_file, *compress_opts,
+                   f"--listed-incremental={snar_file}", *self.src_paths]
+            # Run tar under nocache when it's installed, so streaming the whole source tree
+            # doesn't push everything else out of the page cache
+            if shutil.which("nocache"):
+                cmd.insert(0, "nocache")
             self.job_queue.append(cmd)
+            self.tar_cmd = cmd
+            self.full_backup = full_backup
+            self.meta_cache = p.join(full_destination_path, META_CACHE_NAME)
         else:
             log.debug("No src or dest specified, only executing pre and post actions")
 
         # Check if we have to do something when we're finished
-        if self.post_action:
-            self.job_queue.append(self.post_action)
+        self.job_queue.extend(self.post_actions)
+
+    def add_to_bundle(self, other):
+        """ Folds other's sources and actions into this (bundle) item """
+        # A bundle is one tar, so these can only be taken from its first item
+        for option in ("tar_opts", "compressor", "preallocate", "skip_unchanged"):
+            if getattr(other, option) != getattr(self, option):
+                log.warning("%s has different %s to the rest of bundle %s, using %s",
+                            other.name, option, self.name, getattr(self, option))
+        self.src_paths.extend(other.src_paths)
+        self.pre_actions.extend(other.pre_actions)
+        self.post_actions.extend(other.post_actions)
+        self.show_time = self.show_time or other.show_time
+
+    def scan_source(self, use_iouring=False):
+        """
+        Scans the source tree, for items that skip_unchanged or preallocate, and compares
+        it against the metadata cache from the last successful tar. If skip_unchanged is
+        set and nothing has changed, the tar is taken out of the job queue. Full backups
+        always count as changed.
+        """
+        # This runs before any of the item's jobs, so a pre action could still change
+        # the source after it has been found unchanged
+        if self.skip_unchanged and self.pre_actions:
+            log.warning("%s has a pre action, so its tar can't be skipped when unchanged",
+                        self.name)
+            self.skip_unchanged = False
+        if self.tar_cmd is None or not (self.skip_unchanged or self.preallocate):
+            return
+
+        scan = scan_tree_iouring if use_iouring else scan_tree
+        self.snapshot = {}
+        try:
+            for src_path in self.src_paths:
+                self.snapshot.update(scan(src_path))
+        except OSError as err:
+            # Leave it to tar to report the problem for this item, and don't cache anything
+            log.warning("Could not scan %s: %s", err.filename, err.strerror)
+            self.snapshot = None
+            return
+        self.previous = load_snapshot(self.meta_cache)
+        if self.skip_unchanged and not self.full_backup and self.snapshot == self.previous:
+            log.info("%s is unchanged since the last backup, skipping tar", self.name)
+            self.job_queue.remove(self.tar_cmd)
+            self.snapshot = None
+            return
+
+        if self.preallocate:
+            previous = {} if self.full_backup else self.previous
+            self.changed_size = sum(STAT_RECORD.unpack(stat)[2]
+                                    for path, stat in self.snapshot.items()
+                                    if previous.get(path) != stat)
+
+    def open_tar_output(self):
+        """
+        Opens the archive tar will write to its stdout, preallocating room for its
+        estimated compressed size so the file isn't built up from many small appends.
+        Any overestimate is trimmed once tar is done, and an underestimate just grows.
+        """
+        self.tar_output_fd = os.open(self.tar_output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                     0o644)
+        if self.changed_size:
+            try:
+                vfs = os.fstatvfs(self.tar_output_fd)
+                size = min(int(self.changed_size * PREALLOCATE_RATIO),
+                           int(vfs.f_bavail * vfs.f_frsize * PREALLOCATE_MAX_FREE))
+                if size > 0:
+                    os.posix_fallocate(self.tar_output_fd, 0, size)
+            except OSError as err:
+                log.debug("Could not preallocate %s: %s", self.tar_output, err.strerror)
+        return self.tar_output_fd
+
+    def close_tar_output(self):
+        """ Trims the preallocated archive back to what tar wrote, and closes it """
+        # tar shares this fd's file offset, so it now sits at the end of what was written
+        os.ftruncate(self.tar_output_fd, os.lseek(self.tar_output_fd, 0, os.SEEK_CUR))
+        os.close(self.tar_output_fd)
+        self.tar_output_fd = None
 
     def start(self):
-        """ Processes any jobs (sequentially) found in the job queue """
-        try:
-            for _job in self.job_queue:
-                start_time = timer()
-                log.debug("Executing cmd:: {0}".format(_job))
-                proc = subprocess.Popen(_job, shell=True)
-                proc.wait()
-                log.debug("job {0} finished".format(_job))
-                time_taken = timer() - start_time
-                time_format = "%M mins %S seconds"
-
-                # If job too longer than 3599 seconds (1 hr), display hours as well
-                if time_taken > 3599:
-                    time_format = "%H hrs %M mins %S seconds"
-                cmd_time = time.strftime(time_format, time.gmtime(time_taken))
-                if self.show_time:
-                    log.info("{0} took {1} to complete".format(_job, cmd_time))
+        """ Launches the next job in the job queue, returns its process or None when done """
+        while self.job_queue:
+            self.current_job = self.job_queue.pop(0)
+            stdout = None
+            if self.current_job is self.tar_cmd and self.tar_output:
+                try:
+                    stdout = self.open_tar_output()
+                except OSError as err:
+                    log.error("Could not open %s: %s", self.tar_output, err.strerror)
+                    self.job_queue.clear()
+                    return None
+
+            if self.show_time:
+                self.start_time = timer()
+            log.debug("Executing cmd:: %s", self.current_job)
+            try:
+                return subprocess.Popen(self.current_job, stdout=stdout,
+                                        shell=isinstance(self.current_job, str))
+            except FileNotFoundError:
+                log.error("Could not execute: %s", self.current_job)
+                if stdout:
+                    self.close_tar_output()
+                # Don't carry on with the rest of the queue, eg tar without its pre action
+                self.job_queue.clear()
+        return None
 
-        except FileNotFoundError:
-            log.error("Could not execute: {0}".format(_job))
+    def finish(self, returncode):
+        """ Called once the current job has exited with returncode """
+        log.debug("job %s finished", self.current_job)
+        if self.current_job is self.tar_cmd:
+            if self.tar_output_fd is not None:
+                self.close_tar_output()
+            if returncode == 0 and self.snapshot is not None:
+                save_snapshot(self.meta_cache, self.snapshot, self.previous)
+        if self.show_time:
+            cmd_time = format_time(timer() - self.start_time)
+            log.info("%s took %s to complete", self.current_job, cmd_time)
+
+
+def bundle_items(items):
+    """
+    Combines items with the same bundle name and dest_path into one item, so they are
+    written by a single tar (named after the bundle) rather than one tar each
+    """
+    def dest_key(name, item):
+        return name, p.normpath(item.dest_path) if item.dest_path else None
+
+    # A bundle named after an item would share its directory, archives and snar file
+    item_keys = {dest_key(item.name, item) for item in items if not item.bundle}
+    bundles = {}
+    item_list = []
+    for item in items:
+        if not item.bundle:
+            item_list.append(item)
+            continue
+
+        key = dest_key(item.bundle, item)
+        if key in item_keys:
+            log.error("Bundle %s has the same name and dest_path as an item, so %s is "
+                      "not bundled", item.bundle, item.name)
+            item_list.append(item)
+            continue
+        if key in bundles:
+            bundles[key].add_to_bundle(item)
+            continue
+
+        bundled = copy.copy(item)
+        bundled.name = item.bundle
+        bundled.src_paths = list(item.src_paths)
+        bundled.pre_actions = list(item.pre_actions)
+        bundled.post_actions = list(item.post_actions)
+        bundles[key] = bundled
+        item_list.append(bundled)
+    return item_list
 
 
 def create_backup_items():
@@ -160,18 +571,35 @@ def create_backup_items():
     item_list = []
     try:
         with open(CONFIG_FILE_NAME) as data:
-            j = json.load(data, object_hook=
-                          lambda c: collections.namedtuple('Item', c.keys())(*c.values()))
-
-            pre = getattr(j, "pre_script_action", None)
-            post = getattr(j, "post_script_action", None)
-            showtime = getattr(j, "show_script_time", None)
-            new_log = getattr(j, "log_file", "/var/log/backup_script")
-            other_actions = ScriptAction(pre, post, showtime, log_file=new_log)
-            for bitem in j.backup_list:
-                if is_valid(bitem):
-                    _item = BackupItem(bitem)
-                    item_list.append(_item)
+            j = json.load(data)
+
+            pre = split_action(j.get("pre_script_action"))
+            post = split_action(j.get("post_script_action"))
+            showtime = j.get("show_script_time")
+            new_log = j.get("log_file", "/var/log/backup_script")
+            default_jobs = min(4, os.cpu_count())
+            max_jobs = j.get("max_parallel_jobs", default_jobs)
+            # bool is an int too, but true/false makes no sense as a job count
+            if isinstance(max_jobs, bool) or not isinstance(max_jobs, int) or max_jobs < 1:
+                log.warning("max_parallel_jobs must be a whole number of at least 1, using %s",
+                            default_jobs)
+                max_jobs = default_jobs
+            other_actions = ScriptAction(pre, post, showtime, log_file=new_log,
+                                         max_parallel_jobs=max_jobs)
+            for bitem in j["backup_list"]:
+                if not is_valid(bitem):
+                    continue
+                # If the item is not enabled, let the user know, and don't bother
+                # building it
+                if not bitem["enabled"]:
+                    log.warning("%s is not enabled, skipping ", bitem["name"])
+                    continue
+                unknown = bitem.keys() - CONFIG_ITEM_KEYS
+                if unknown:
+                    log.warning("Ignoring unknown json keys in %s: %s", bitem["name"],
+                                ", ".join(sorted(unknown)))
+                item_list.append(BackupItem(ConfigItem(
+                    **{key: val for key, val in bitem.items() if key in CONFIG_ITEM_KEYS})))
 
             return item_list, other_actions
 
@@ -185,10 +613,15 @@ def create_lock_file():
         Write a lock file, incase something is waiting on us to finish
         its more like an indication we're still busy
     """
-    if p.exists(LOCK_FILE_NAME):
+    # O_EXCL makes the check and the create one atomic step, so two scripts starting
+    # together can't both get the lock. Our pid goes in it to help spot a stale lock.
+    try:
+        fd = os.open(LOCK_FILE_NAME, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
         return FileExistsError
 
-    open(LOCK_FILE_NAME, 'a').close()
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
     return None
 
 
@@ -202,6 +635,13 @@ def release_lock_file():
 
 
 if __name__ == '__main__':
+    # Only needed when run as a script, so not paid for when this is imported
+    import argparse
+    import datetime as t
+    import sys
+    import textwrap
+    from logging.handlers import BufferingHandler
+
     parser = argparse.ArgumentParser(
         prog='backup_script.py',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -215,9 +655,17 @@ if __name__ == '__main__':
                         help='Does a full backup of the directory (otherwise incremental)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Turns on warnings')
     parser.add_argument('-c', '--console_log', action='store_true', help='Log to console only')
+    parser.add_argument('--use-iouring', action='store_true',
+                        help='Batch the source scan stat calls through io_uring '
+                             '(needs liburing and kernel 5.6+)')
     args = parser.parse_args()
 
+    # Logging can't be set up until the config (and so log_file) has been read, so hold
+    # on to anything logged while reading it, eg disabled items, to log once it is
+    config_log = BufferingHandler(capacity=sys.maxsize)
+    log.getLogger().addHandler(config_log)
     backup_items, script_actions = create_backup_items()
+    log.getLogger().removeHandler(config_log)
 
     # Sort out some logging
     log_level = log.INFO
@@ -226,78 +674,95 @@ if __name__ == '__main__':
 
     if args.console_log:
         log.basicConfig(level=log_level, format='%(asctime)s %(levelname)s: %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
+                        datefmt='%Y-%m-%d %H:%M:%S', force=True)
         log.info("Script logging to console only")
     else:
         try:
             log.basicConfig(level=log_level, format='%(asctime)s %(levelname)s: %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S', filename=script_actions.log_file)
+                            datefmt='%Y-%m-%d %H:%M:%S', filename=script_actions.log_file,
+                            force=True)
         except PermissionError:
             print("ERROR: Cannot write to supplied log location: {}".format(script_actions.log_file))
             # User has to exit, we don't know where to write our logs too.
             quit(0)
 
+    for record in config_log.buffer:
+        log.getLogger().handle(record)
+
     if backup_items is None:
         log.info("No backup jobs found, exiting")
         sys.exit()
 
     date = t.date.today()
-    jobs = []
-    threads = []
 
     ret = create_lock_file()
     if ret is FileExistsError:
         log.error(
-            "Backup is still running (delete {0} if this isn't correct)".format(LOCK_FILE_NAME))
+            "Backup is still running (delete %s if this isn't correct)", LOCK_FILE_NAME)
         sys.exit()
 
     script_start_time = timer()
 
-    # Start iterating over the list of items to backup. If the item
-    # is not enabled, let the user know, and move onto the next item.
-    for item in backup_items:
-        if not item.is_enabled():
-            log.warning("{0} is not enabled, skipping ".format(item.name))
-            continue
-
-        # Queue up the jobs we have to do
-        item.queue_items(full_backup=args.full)
-
-        # Append the item to the jobs list.
-        jobs.append(item)
+    # Items sharing a bundle are tarred together, then queue up the jobs we have to do
+    jobs = bundle_items(backup_items)
+    # Split the cpus between the items that can run at once, so their compressors
+    # aren't each trying to use all of them
+    parallel_jobs = min(script_actions.max_parallel_jobs, len(jobs)) or 1
+    threads = max(1, os.cpu_count() // parallel_jobs)
+    for job in jobs:
+        job.queue_items(full_backup=args.full, threads=threads)
 
     if script_actions.preaction:
         try:
-            pre = subprocess.Popen(script_actions.preaction, shell=True)
-            pre.wait()
+            subprocess.run(script_actions.preaction,
+                           shell=isinstance(script_actions.preaction, str), check=False)
         except FileNotFoundError:
             log.error("Failed to run the pre_action_script command")
 
-    for job in jobs:
-        t = threading.Thread(target=job.start)
-        threads.append(t)
-        t.start()
+    # Scan the sources of items that need it up front, rather than holding up the
+    # other items' jobs while one item scans
+    if any(job.skip_unchanged or job.preallocate for job in jobs):
+        use_iouring = args.use_iouring and iouring_available()
+        for job in jobs:
+            job.scan_source(use_iouring=use_iouring)
+
+    # Start the first job of up to max_parallel_jobs items, then as each job exits, start
+    # the next one queued for that item. Once an item has worked through its queue, its
+    # slot is handed to the next waiting item. Running every item at once just has the
+    # tars fighting over the same disks.
+    waiting = list(jobs)
+    running = {}
+    while waiting or running:
+        while waiting and len(running) < script_actions.max_parallel_jobs:
+            job = waiting.pop(0)
+            proc = job.start()
+            if proc:
+                running[proc.pid] = (proc, job)
+        if not running:
+            continue
 
-    for thread in threads:
-        thread.join()
+        # Sleep in the kernel until any of our children exits
+        pid, status = os.waitpid(-1, 0)
+        if pid not in running:
+            continue
+        proc, job = running.pop(pid)
+        # We've reaped it ourselves, so let Popen know it's done
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        job.finish(proc.returncode)
+        proc = job.start()
+        if proc:
+            running[proc.pid] = (proc, job)
 
     if script_actions.postaction:
         try:
-            post = subprocess.Popen(script_actions.postaction, shell=True)
-            post.wait()
+            subprocess.run(script_actions.postaction,
+                           shell=isinstance(script_actions.postaction, str), check=False)
         except FileNotFoundError:
             log.error("Failed to run the pre_action_script command")
 
-    time_taken = timer() - script_start_time
-    time_format = "%M mins %S seconds"
-    # If job too longer than 3599 seconds (1 hr), display hours as well
-    if time_taken > 3599:
-        time_format = "%H hrs %M mins %S seconds"
-
-    elapsed_time = time.strftime(time_format, time.gmtime(time_taken))
-
     if script_actions.showtime:
-        log.info("Backup script took {0} to complete".format(elapsed_time))
+        elapsed_time = format_time(timer() - script_start_time)
+        log.info("Backup script took %s to complete", elapsed_time)
 
     log.info("Script finished")
 